@@ -2,15 +2,97 @@
 # Description: turbostat netdata python.d module
 # Author: Steven Noonan (tycho)
 
-import copy
+import errno
 import os
+import select
 import struct
 import subprocess
-import time
+
+try:
+    import numpy as np
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+    HAS_FUTURES = True
+except ImportError:
+    HAS_FUTURES = False
+
+from third_party.monotonic import monotonic
+
+try:
+    from time import monotonic_ns
+except ImportError:
+    # Python < 3.7 only has the float clock
+    def monotonic_ns():
+        return int(monotonic() * 1e9)
 
 from bases.FrameworkServices.SimpleService import SimpleService
 
-_BASE10_LINES = set(['CPU', 'core', 'IRQ', 'SMI', 'package'])
+def _parse_cpu(value):
+    # e.g. 'CPU: 3 flags 0x7'
+    return int(value.split()[0])
+
+def _parse_dec(value):
+    return int(value, 10)
+
+def _parse_hex(value):
+    return int(value, 16)
+
+# The `turbostat --Dump` fields we use, keyed by their raw name, mapping to the
+# name we store them under and how to parse the value. Everything else is skipped.
+_PARSERS = {
+    b'CPU': ('CPU', _parse_cpu),
+    b'core': ('core', _parse_dec),
+    b'package': ('package', _parse_dec),
+    b'TSC': ('TSC', _parse_hex),
+    b'aperf': ('aperf', _parse_hex),
+    b'mperf': ('mperf', _parse_hex),
+    b'Joules PKG': ('Joules PKG', _parse_hex),
+    b'Joules RAM': ('Joules RAM', _parse_hex),
+    b'Joules GFX': ('Joules GFX', _parse_hex),
+}
+
+_U64 = struct.Struct('<Q')
+
+MSR_TSC = 0x10
+MSR_MPERF = 0xE7
+MSR_APERF = 0xE8
+MSR_PKG_ENERGY_STATUS = 0x611
+MSR_DRAM_ENERGY_STATUS = 0x619
+MSR_PP1_ENERGY_STATUS = 0x641
+MSR_AMD_PKG_ENERGY_STATUS = 0xC001029B
+MSR_RAPL_POWER_UNIT = 0x606
+MSR_AMD_RAPL_POWER_UNIT = 0xC0010299
+
+# Per-thread counters, named the same as in the `turbostat --Dump` output
+_CPU_MSRS = [
+    ('TSC', MSR_TSC),
+    ('aperf', MSR_APERF),
+    ('mperf', MSR_MPERF),
+]
+
+# Per-package RAPL energy counters, the metric they feed and their candidate
+# addresses in order of preference
+_PKG_MSRS = [
+    ('Joules PKG', 'pkg_watts', (MSR_PKG_ENERGY_STATUS, MSR_AMD_PKG_ENERGY_STATUS)),
+    ('Joules RAM', 'ram_watts', (MSR_DRAM_ENERGY_STATUS,)),
+    ('Joules GFX', 'gfx_watts', (MSR_PP1_ENERGY_STATUS,)),
+]
+
+# How to name the chart a CPU goes in, for each `split_by` choice
+SPLIT_SUFFIXES = {
+    'package': lambda assignment: 'pkg%d' % (assignment['package'],),
+    'llc': lambda assignment: 'pkg%d_llc%d' % (assignment['package'], assignment['llc_id']),
+    'core': lambda assignment: 'pkg%d_core%d' % (assignment['package'], assignment['core']),
+    'logical': lambda assignment: 'cpu%d' % (assignment['cpuidx'],),
+}
+
+# Which row of the sample arrays each counter goes in
+_CPU_ROWS = dict((name, j) for j, (name, offset) in enumerate(_CPU_MSRS))
+_PKG_ROWS = dict((name, j) for j, (name, metric, offsets) in enumerate(_PKG_MSRS))
 
 CHART_TEMPLATES = {
     'power': {
@@ -37,70 +119,344 @@ CHART_TEMPLATES = {
 DEVNULL = open(os.devnull, 'wb')
 
 def read_file_line(path):
-    return open(path, 'rt').read().strip()
+    # sysfs attributes are always smaller than a page, so a single read() will do
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return os.read(fd, 4096).decode('ascii').strip()
+    finally:
+        os.close(fd)
 
-def get_llc_dirname():
-    for dirpath, dirnames, filenames in os.walk('/sys/devices/system/cpu/cpu0/cache'):
-        dirnames = list(filter(lambda x: x.startswith('index'), dirnames))
-        dirnames.sort()
-        return dirnames[-1]
+_llc_dirname = None
 
-def get_rapl_power_unit(cpu):
-    proc = subprocess.Popen(['turbostat', '-c', str(cpu), '-d', '0'], stdout=DEVNULL, stderr=subprocess.PIPE)
-    for line in proc.stderr:
-        line = line.decode('utf-8').rstrip()
-
-        if not line:
+def get_llc_dirname():
+    global _llc_dirname
+    if _llc_dirname is None:
+        # Compare the indices numerically, 'index10' sorts before 'index9' as a string
+        names = [name for name in os.listdir('/sys/devices/system/cpu/cpu0/cache')
+                 if name.startswith('index') and name[5:].isdigit()]
+        _llc_dirname = max(names, key=lambda name: int(name[5:]))
+    return _llc_dirname
+
+if hasattr(os, 'preadv'):
+    def read_msrs(plan):
+        # Reads straight into the sample arrays, no bytes objects or unpacking involved
+        for fd, buffers, offset in plan:
+            os.preadv(fd, buffers, offset)
+else:
+    # Python 3.3 - 3.6 have os.pread() but not os.preadv()
+    def read_msrs(plan):
+        for fd, buffers, offset in plan:
+            buffers[0][0] = read_msr(fd, offset)
+
+def parse_cpu_list(text):
+    # e.g. '0-3,8-11'
+    cpus = set()
+    for part in text.split(','):
+        if part:
+            first, _, last = part.partition('-')
+            cpus.update(range(int(first), int(last or first) + 1))
+    return cpus
+
+def get_numa_nodes():
+    try:
+        return dict((int(name[4:]), parse_cpu_list(read_file_line('/sys/devices/system/node/%s/cpulist' % (name,))))
+                    for name in os.listdir('/sys/devices/system/node') if name.startswith('node') and name[4:].isdigit())
+    except OSError:
+        # No NUMA support in the kernel, treat everything as one node
+        return {}
+
+def pin_thread(cpus):
+    try:
+        os.sched_setaffinity(0, cpus)
+    except OSError:
+        # e.g. a cpuset doesn't let us run there, just read from wherever we are
+        pass
+
+def read_msr(fd, offset):
+    return _U64.unpack_from(os.pread(fd, 8, offset))[0]
+
+def probe_msr(fd, offsets):
+    for offset in offsets:
+        try:
+            read_msr(fd, offset)
+        except OSError as e:
+            # The msr driver returns EIO for registers the CPU doesn't implement
+            if e.errno != errno.EIO:
+                raise
             continue
-
-        line = line.split()
-
-        if line[1] == 'MSR_RAPL_POWER_UNIT:' or line[1] == 'MSR_RAPL_PWR_UNIT:':
-            return int(line[2], 16)
-
-    raise IOError("Couldn't find RAPL power unit")
+        return offset
+    return None
+
+def open_msr_fds(cpus):
+    fds = {}
+    if not hasattr(os, 'pread'):
+        # Python < 3.3, stick to invoking turbostat
+        return fds
+    try:
+        for cpuidx in cpus:
+            fds[cpuidx] = os.open('/dev/cpu/%d/msr' % (cpuidx,), os.O_RDONLY | os.O_CLOEXEC)
+    except OSError:
+        # Either the msr driver isn't loaded or we don't have CAP_SYS_RAWIO.
+        for fd in fds.values():
+            os.close(fd)
+        return {}
+    return fds
+
+def read_process_output(proc, timeout):
+    fd = proc.stdout.fileno()
+    blob = bytearray()
+    deadline = monotonic() + timeout
+    while True:
+        remaining = deadline - monotonic()
+        if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+            # Don't let a wedged turbostat stall the collection thread
+            proc.kill()
+            proc.wait()
+            raise IOError("turbostat didn't finish within %d seconds" % (timeout,))
+        chunk = os.read(fd, 65536)
+        if not chunk:
+            break
+        blob += chunk
+    proc.stdout.close()
+    proc.wait()
+    return bytes(blob)
+
+def parse_rapl_power_units(blob):
+    # `turbostat --debug` reports the register once per package, e.g.
+    # 'cpu0: MSR_RAPL_POWER_UNIT: 0x000a0e03 (0.125000 Watts, ...)'
+    units = {}
+    for line in blob.splitlines():
+        fields = line.split()
+        if len(fields) >= 3 and fields[1] in (b'MSR_RAPL_POWER_UNIT:', b'MSR_RAPL_PWR_UNIT:'):
+            try:
+                units[int(fields[0][3:-1])] = int(fields[2], 16)
+            except ValueError:
+                continue
+    return units
 
 class Service(SimpleService):
+    # RAPL units can't change until the next reboot, so they are shared by all
+    # jobs and survive check() being retried.
+    _rapl_units = {}
+
     def __init__(self, configuration=None, name=None):
+        # Set before anything that can raise, `__del__` needs them for `cleanup()`
+        self._msr_fds = {}
+        self._msr_plans = []
+        self._msr_workers = []
         SimpleService.__init__(self, configuration=configuration, name=name)
         self.order = []
         self.definitions = {}
         self.fake_name = "cpu"
         self.assignment = {}
-        self.last_turbostat = None
-        self.last_turbostat_time = 0
+        self._last_ns = 0
+        self.last_counters = None
+        self.last_energy = None
         self.rapl = {}
+        self._samples = []
+        self._pkg_msrs = []
+        self._cpus = []
+        self._cpu_index = {}
+        self._cpu_pkg_index = []
+        self._packages = []
+        self._pkg_index = {}
+        self._pkg_cpus = []
+        self._data_keys = ()
+        self._rapl_idx = None
+        self._energy_units = None
+
+    def __del__(self):
+        self.cleanup()
+
+    def cleanup(self):
+        for worker in self._msr_workers:
+            worker.shutdown(wait=False)
+        self._msr_workers = []
+        self._msr_plans = []
+        for fd in self._msr_fds.values():
+            os.close(fd)
+        self._msr_fds = {}
+
+    def _setup_msr_groups(self):
+        # Split the MSR reads up by NUMA node, so that each node's CPUs get read
+        # by a thread running on that node and the nodes are read in parallel.
+        nodes = get_numa_nodes()
+        node_of = {}
+        for node, cpus in nodes.items():
+            for cpuidx in cpus:
+                node_of[cpuidx] = node
+
+        groups = []
+        for cpuidx in self._cpus:
+            if node_of.get(cpuidx) not in groups:
+                groups.append(node_of.get(cpuidx))
+
+        # Each set of sample arrays gets per-group plans of (fd, target buffer,
+        # MSR) to read, so the update loop does no lookups at all.
+        self._msr_plans = []
+        for counters, energy in self._samples:
+            plans = dict((node, []) for node in groups)
+            for i, cpuidx in enumerate(self._cpus):
+                fd = self._msr_fds[cpuidx]
+                for j, (name, offset) in enumerate(_CPU_MSRS):
+                    plans[node_of.get(cpuidx)].append((fd, (counters[j, i:i + 1],), offset))
+            for i, cpuidx in enumerate(self._pkg_cpus):
+                fd = self._msr_fds[cpuidx]
+                for j, (name, offset) in enumerate(self._pkg_msrs):
+                    if offset is not None:
+                        plans[node_of.get(cpuidx)].append((fd, (energy[j, i:i + 1],), offset))
+            self._msr_plans.append([plans[node] for node in groups])
+
+        if len(groups) > 1 and HAS_FUTURES:
+            # Each worker has a single thread, so pinning it with the first
+            # task sticks for all the later ones.
+            self._msr_workers = [ThreadPoolExecutor(max_workers=1) for node in groups]
+            for worker, node in zip(self._msr_workers, groups):
+                if node is not None:
+                    worker.submit(pin_thread, nodes[node])
+
+    def _probe_pkg_msrs(self, fd):
+        return [(name, probe_msr(fd, offsets)) for name, metric, offsets in _PKG_MSRS]
+
+    def _get_rapl_units(self, pkgidx, cpuidx, reported):
+        if pkgidx in self._rapl_units:
+            return self._rapl_units[pkgidx]
+
+        msr = None
+        if cpuidx in self._msr_fds:
+            try:
+                offset = probe_msr(self._msr_fds[cpuidx], (MSR_RAPL_POWER_UNIT, MSR_AMD_RAPL_POWER_UNIT))
+                if offset is not None:
+                    msr = read_msr(self._msr_fds[cpuidx], offset)
+            except OSError:
+                pass
+        if msr is None:
+            # Settle for what turbostat told us, if anything
+            msr = reported
+        if msr is None:
+            # Neither we nor turbostat could rdmsr :(
+            return None
+
+        power_units = 1.0 / (1 << (msr & 0xF))
+        energy_units = 1.0 / (1 << ((msr >> 8) & 0x1F))
+        self._rapl_units[pkgidx] = (power_units, energy_units)
+        return self._rapl_units[pkgidx]
 
     def _parse_stat_line(self, line):
-        line = line.split(b': ', 1)
+        sep = line.find(b': ')
 
         # Line has no delimiter, probably a debug message of some kind. Ignore it.
-        if len(line) == 1:
+        if sep == -1:
             return None
 
-        name, value = line[0].decode('utf-8'), line[1]
+        try:
+            name, parse = _PARSERS[line[:sep]]
+        except KeyError:
+            # Not a field we have any use for, don't bother parsing it
+            return None
 
-        if name == 'CPU':
-            return name, int(value.split()[0])
+        try:
+            return name, parse(line[sep + 2:])
+        except (ValueError, IndexError):
+            return None
 
+    def _invoke_turbostat(self):
+        """
+        Samples the counters of every CPU and package we know about.
+        :return: <tuple>: (monotonic timestamp in ns, per-CPU counters in `_CPU_MSRS` order,
+                 per-package energy counters in `_PKG_MSRS` order)
+        """
+        if not self._msr_fds:
+            return self._sample_turbostat()
+
+        sample = self._next_sample()
+        counters, energy = self._samples[sample]
+        plans = self._msr_plans[sample]
+
+        now = monotonic_ns()
         try:
-            if name in _BASE10_LINES:
-                value = int(value, 10)
+            if self._msr_workers:
+                futures = [worker.submit(read_msrs, plan) for worker, plan in zip(self._msr_workers, plans)]
+                for future in futures:
+                    future.result()
             else:
-                value = int(value, 16)
-        except:
-            return None
+                for plan in plans:
+                    read_msrs(plan)
+        except OSError as e:
+            if e.errno not in (errno.EPERM, errno.EACCES):
+                raise
+            self.error("Lost access to /dev/cpu/*/msr, falling back to invoking turbostat.")
+            self.cleanup()
+            return self._sample_turbostat()
+
+        return now, counters, energy
+
+    def _next_sample(self):
+        # Fill whichever set of arrays doesn't hold the previous sample
+        return 1 if self._samples[0][0] is self.last_counters else 0
+
+    def _sample_turbostat(self):
+        counters, energy = self._samples[self._next_sample()]
+        now, blob = self._dump_turbostat()
+
+        # Parse straight into the sample arrays, without building dicts for every CPU
+        energy.fill(0)
+        seen = 0
+        i = None
+        for line in blob.splitlines():
+            if not line:
+                i = None
+                continue
 
-        return name, value
+            stat = self._parse_stat_line(line)
+            if stat is None:
+                continue
 
-    def _invoke_turbostat(self):
+            name, value = stat
+
+            if name == 'CPU':
+                i = self._cpu_index.get(value)
+                if i is not None:
+                    seen += 1
+            elif i is None:
+                continue
+            elif name in _CPU_ROWS:
+                counters[_CPU_ROWS[name], i] = value
+            elif name in _PKG_ROWS:
+                energy[_PKG_ROWS[name], self._cpu_pkg_index[i]] = value
+
+        if seen != len(self._cpus):
+            raise IOError("turbostat only reported %d of %d CPUs" % (seen, len(self._cpus)))
+
+        return now, counters, energy
+
+    def _pack_dump(self, cpus):
+        counters = np.array([[cpus[cpuidx][name] for cpuidx in self._cpus] for name, offset in _CPU_MSRS],
+                            dtype=np.uint64)
+        energy = np.zeros((len(_PKG_MSRS), len(self._packages)), dtype=np.uint64)
+        for stats in cpus.values():
+            # turbostat only reports package counters for the first CPU in each package
+            if 'Joules PKG' in stats:
+                i = self._pkg_index[stats['package']]
+                for j, (name, metric, offsets) in enumerate(_PKG_MSRS):
+                    energy[j, i] = stats.get(name, 0)
+        return counters, energy
+
+    def _dump_turbostat(self, debug=False):
+        if debug:
+            # The debug messages go to stderr, so read them from the same pipe
+            proc = subprocess.Popen(['turbostat', '--debug', '--Dump'], stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT, bufsize=0)
+        else:
+            proc = subprocess.Popen(['turbostat', '--Dump'], stdout=subprocess.PIPE, stderr=DEVNULL, bufsize=0)
+        now = monotonic_ns()
+        return now, read_process_output(proc, self.update_every)
+
+    def _parse_dump(self, blob):
         cpus = {}
-        proc = subprocess.Popen(['turbostat', '--Dump'], stdout=subprocess.PIPE, stderr=DEVNULL)
         cpu = None
-        now = time.time()
-        for line in proc.stdout:
-            line = line.rstrip()
-
+        for line in blob.splitlines():
+            # Every CPU gets its own block in the dump, separated by blank lines
             if not line:
                 cpu = None
                 continue
@@ -112,88 +468,72 @@ class Service(SimpleService):
 
             name, value = stat
 
-            if cpu is None and name != 'CPU':
-                continue
-
             if name == 'CPU':
                 cpu = {}
                 cpus[value] = cpu
+            elif cpu is None:
+                continue
 
             cpu[name] = value
 
-        return now, cpus
-
-    def _dict_delta(self, before, after):
-        result = {}
-        for key, value in before.items():
-            try:
-                result[key] = after[key] - value
-            except TypeError:
-                # Probably not a numeric type. Don't worry about it.
-                pass
-
-        return result
+        return cpus
 
     def _get_data(self):
-        data = {}
-
-        now, turbostat = self._invoke_turbostat()
-
-        for cpuidx, stats in turbostat.items():
-            last_stats = self.last_turbostat[cpuidx]
+        now, counters, energy = self._invoke_turbostat()
 
-            delta = self._dict_delta(last_stats, stats)
+        # Measured on the monotonic clock, so wall clock adjustments can't skew the rates
+        elapsed = (now - self._last_ns) * 1e-9
+        tsc, aperf, mperf = (counters - self.last_counters).astype(np.float64)
 
-            tsc = delta['TSC']
-            aperf = delta['aperf']
-            mperf = delta['mperf']
+        avg_mhz = aperf / elapsed / 1e3
+        # mperf doesn't tick while a CPU sits idle, so it can stay put for a whole interval
+        busy_mhz = np.divide(tsc * aperf, mperf, out=np.zeros_like(tsc), where=mperf != 0) / elapsed / 1e3
 
-            time = now - self.last_turbostat_time
-            avg_mhz = aperf / time / 1e3
-            busy_mhz = (tsc / 1e3) * aperf / mperf / time
+        # Only the low 32 bits of the RAPL energy counters are defined, and they
+        # wrap around every few minutes under load. Truncating to uint32 before
+        # subtracting takes care of both.
+        delta = (energy[:, self._rapl_idx].astype(np.uint32) -
+                 self.last_energy[:, self._rapl_idx].astype(np.uint32)).astype(np.float64)
+        watts = delta * self._energy_units / elapsed * 100.0
 
-            cpuname = 'cpu%d' % (cpuidx,)
-            data[cpuname + '_avg_mhz'] = avg_mhz
-            data[cpuname + '_busy_mhz'] = busy_mhz
-
-            pkgidx = self.assignment[cpuname]['package']
-            pkgname = 'pkg%d' % (pkgidx,)
-
-            if pkgname + '_ram_watts' not in data and pkgidx in self.rapl:
-                power_units, energy_units = self.rapl[pkgidx]
-
-                ram = max(0, delta['Joules RAM'])
-                pkg = max(0, delta['Joules PKG'])
-                gfx = max(0, delta['Joules GFX'])
+        values = np.concatenate((avg_mhz, busy_mhz, watts.ravel()))
+        data = dict(zip(self._data_keys, values.tolist()))
 
-                data[pkgname + '_ram_watts'] = ram * energy_units / time * 100.0
-                data[pkgname + '_pkg_watts'] = pkg * energy_units / time * 100.0
-                data[pkgname + '_gfx_watts'] = gfx * energy_units / time * 100.0
-
-        self.last_turbostat_time = now
-        self.last_turbostat = turbostat
+        self._last_ns = now
+        self.last_counters = counters
+        self.last_energy = energy
 
         return data
 
     def check(self):
+        if not HAS_NUMPY:
+            self.error("'numpy' package is needed to use turbostat module")
+            return False
+
         split_by = None
         try:
             split_by = str(self.configuration['split_by'])
-            if split_by not in ['logical', 'llc', 'core', 'package']:
+            if split_by not in SPLIT_SUFFIXES:
                 self.error("Value '%s' for 'split_by' configuration option isn't a valid choice, ignoring" % (split_by,))
                 split_by = None
         except (KeyError, TypeError):
             self.alert("No 'split_by' option specified. Not dividing CPUs up by topology.")
 
         try:
-            self.last_turbostat_time, self.last_turbostat = self._invoke_turbostat()
+            now, blob = self._dump_turbostat(debug=True)
+            cpus = self._parse_dump(blob)
         except:
             self.error("Could not invoke turbostat, disabling.")
             return False
 
+        reported_rapl = {}
+        for cpuidx, msr in parse_rapl_power_units(blob).items():
+            if cpuidx in cpus:
+                reported_rapl[cpus[cpuidx]['package']] = msr
+
         llc_dirname = get_llc_dirname()
 
-        for cpuidx, stats in self.last_turbostat.items():
+        for cpuidx, stats in cpus.items():
             cpuname = 'cpu%d' % (cpuidx,)
             pkgidx = stats['package']
             self.assignment[cpuname] = {
@@ -203,60 +543,98 @@ class Service(SimpleService):
                 'llc_id': int(read_file_line('/sys/devices/system/cpu/cpu%d/cache/%s/id' % (cpuidx, llc_dirname)))
             }
 
-            if pkgidx not in self.rapl:
-                try:
-                    msr = get_rapl_power_unit(cpuidx)
-                except IOError:
-                    # We don't have CAP_SYS_RAWIO and can't rdmsr :(
-                    continue
-                power_units = 1.0 / (1 << (msr & 0xF))
-                energy_units = 1.0 / (1 << ((msr >> 8) & 0x1F));
-                self.rapl[pkgidx] = (power_units, energy_units)
-
         if len(self.assignment) == 0:
             self.error("Could not find any CPUs in turbostat dump")
             return False
 
+        # Counters are kept in arrays indexed by position in these lists
+        self._cpus = sorted(assignment['cpuidx'] for assignment in self.assignment.values())
+        pkg_cpus = {}
+        for cpuidx in self._cpus:
+            pkg_cpus.setdefault(self.assignment['cpu%d' % (cpuidx,)]['package'], cpuidx)
+        self._packages = sorted(pkg_cpus)
+        self._pkg_index = dict((pkgidx, i) for i, pkgidx in enumerate(self._packages))
+        self._pkg_cpus = [pkg_cpus[pkgidx] for pkgidx in self._packages]
+        self._cpu_index = dict((cpuidx, i) for i, cpuidx in enumerate(self._cpus))
+        self._cpu_pkg_index = [self._pkg_index[self.assignment['cpu%d' % (cpuidx,)]['package']] for cpuidx in self._cpus]
+
+        # Two sets of sample arrays, so one can be filled while the other holds
+        # the previous sample
+        self._samples = [(np.zeros((len(_CPU_MSRS), len(self._cpus)), dtype=np.uint64),
+                          np.zeros((len(_PKG_MSRS), len(self._packages)), dtype=np.uint64))
+                         for _ in range(2)]
+
+        # Opened once here and kept for as long as the job lives
+        self.cleanup()
+        self._msr_fds = open_msr_fds(self._cpus)
+
+        for pkgidx, cpuidx in zip(self._packages, self._pkg_cpus):
+            units = self._get_rapl_units(pkgidx, cpuidx, reported_rapl.get(pkgidx))
+            if units is not None:
+                self.rapl[pkgidx] = units
+
+        rapl_idx = [i for i, pkgidx in enumerate(self._packages) if pkgidx in self.rapl]
+        self._rapl_idx = np.array(rapl_idx, dtype=np.intp)
+        self._energy_units = np.array([self.rapl[self._packages[i]][1] for i in rapl_idx])
+
+        # Chart keys for every value `_get_data()` computes, in the order it computes them
+        self._data_keys = tuple(
+            ['cpu%d_avg_mhz' % (cpuidx,) for cpuidx in self._cpus] +
+            ['cpu%d_busy_mhz' % (cpuidx,) for cpuidx in self._cpus] +
+            ['pkg%d_%s' % (self._packages[i], metric) for name, metric, offsets in _PKG_MSRS for i in rapl_idx]
+        )
+
+        self._last_ns = now
+        self.last_counters, self.last_energy = self._pack_dump(cpus)
+
+        if self._msr_fds:
+            # Take the baseline sample straight from the MSRs so that every
+            # update reads the same way.
+            try:
+                self._pkg_msrs = self._probe_pkg_msrs(self._msr_fds[self._cpus[0]])
+                self._setup_msr_groups()
+                self._last_ns, self.last_counters, self.last_energy = self._invoke_turbostat()
+            except (OSError, KeyError):
+                self.info("Could not read /dev/cpu/*/msr directly, falling back to invoking turbostat.")
+                self.cleanup()
+        else:
+            self.info("No access to /dev/cpu/*/msr, falling back to invoking turbostat every update.")
+
         order = []
 
         packages_seen = []
 
+        ordered_cpunames = sorted(self.assignment, key=lambda v: self.assignment[v]['cpuidx'])
+
+        split_suffix = SPLIT_SUFFIXES.get(split_by, lambda assignment: None)
+
         for chart, template in CHART_TEMPLATES.items():
-            for cpuname in sorted(self.assignment, key=lambda v: int(v[3:].split('_')[0])):
+            metrics = template.get('_metrics', [chart])
+            per = template.get('_per', 'logical')
+            divisor = template.get('_divisor', 1000)
+            substitutions = template.get('_replace', [])
+
+            # Per-package charts are always split by package
+            suffix_for = SPLIT_SUFFIXES['package'] if per == 'package' else split_suffix
+
+            for cpuname in ordered_cpunames:
                 assignment = self.assignment[cpuname]
 
                 cpuidx = assignment['cpuidx']
                 pkgidx = assignment['package']
                 pkgname = 'pkg%d' % (pkgidx,)
                 coreidx = assignment['core']
-                corename = 'core%d' % (coreidx,)
-                llcname = 'llc%d' % (assignment['llc_id'])
-
-                if split_by == 'package':
-                    suffix = pkgname
-                elif split_by == 'llc':
-                    suffix = pkgname + '_' + llcname
-                elif split_by == 'core':
-                    suffix = pkgname + '_' + corename
-                elif split_by == 'logical':
-                    suffix = cpuname
-                else:
-                    suffix = None
-
-                metrics = template.get('_metrics', [chart])
-                per = template.get('_per', 'logical')
-                divisor = template.get('_divisor', 1000)
-                substitutions = template.get('_replace', [])
 
-                if per == 'package':
-                    suffix = pkgname
+                suffix = suffix_for(assignment)
 
                 chartname = chart
                 if suffix is not None:
                     chartname += '_' + suffix
 
                 if chartname not in self.definitions:
-                    self.definitions[chartname] = copy.deepcopy(template)
+                    # Only `lines` is ever modified, so a shallow copy will do
+                    self.definitions[chartname] = template.copy()
+                    self.definitions[chartname]['lines'] = []
                     order.append((chartname, (pkgidx, coreidx, cpuidx)))
 
                 prefix = cpuname